@@ -11,6 +11,7 @@ try:
     from .sqlqueue import SQLiteQueue, FIFOSQLiteQueue, FILOSQLiteQueue, \
         UniqueQ  # noqa
     from .sqlackqueue import SQLiteAckQueue, UniqueAckQ
+    from .spsc import SPSCSQLiteQueue  # noqa
 except ImportError:
     import logging
 
@@ -18,5 +19,6 @@ except ImportError:
     log.info("No sqlite3 module found, sqlite3 based queues are not available")
 
 __all__ = ["Queue", "SQLiteQueue", "FIFOSQLiteQueue", "FILOSQLiteQueue",
-           "UniqueQ", "PDict", "SQLiteAckQueue", "UniqueAckQ", "Empty", "Full",
+           "UniqueQ", "PDict", "SQLiteAckQueue", "UniqueAckQ",
+           "SPSCSQLiteQueue", "Empty", "Full",
            "__author__", "__license__", "__version__"]
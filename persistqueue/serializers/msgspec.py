@@ -0,0 +1,42 @@
+#! coding = utf-8
+
+"""
+A serializer that uses the msgpack codec of msgspec, which is considerably
+faster than msgpack and pickle, and adds a 4 byte length prefix to store
+multiple objects per file.
+"""
+
+from __future__ import absolute_import
+import msgspec
+import struct
+
+# Encoders/decoders are reused, creating one on every call is expensive.
+_encoder = msgspec.msgpack.Encoder()
+_sorted_encoder = msgspec.msgpack.Encoder(order='sorted')
+_decoder = msgspec.msgpack.Decoder()
+
+
+def dump(value, fp, sort_keys=False):
+    "Serialize value as msgpack to a byte-mode file object"
+    packed = dumps(value, sort_keys=sort_keys)
+    length = struct.pack("<L", len(packed))
+    fp.write(length)
+    fp.write(packed)
+
+
+def dumps(value, sort_keys=False):
+    "Serialize value as msgpack to bytes"
+    if sort_keys:
+        return _sorted_encoder.encode(value)
+    return _encoder.encode(value)
+
+
+def load(fp):
+    "Deserialize one msgpack value from a byte-mode file object"
+    length = struct.unpack("<L", fp.read(4))[0]
+    return _decoder.decode(fp.read(length))
+
+
+def loads(bytes_value):
+    "Deserialize one msgpack value from bytes"
+    return _decoder.decode(bytes_value)
@@ -0,0 +1,156 @@
+# coding=utf-8
+
+"""A sqlite3 based persistent queue for a single producer and consumer."""
+
+import collections
+import logging
+import threading
+import time as _time
+
+from persistqueue.sqlqueue import SQLiteQueue, _unflushed
+
+log = logging.getLogger(__name__)
+
+# Types of the raw items which can be stored in the data column
+_BLOB_TYPES = (bytes, bytearray, memoryview, type(u''))
+
+
+class SPSCSQLiteQueue(SQLiteQueue):
+    """SQLite3 based FIFO queue with an in-memory write-behind buffer.
+
+    `put` only appends the item to a buffer and a background writer thread
+    writes the buffered items to sqlite in batches, so the producer never
+    waits for sqlite. `get` takes the items from sqlite first, then from the
+    buffer, so items which are got before they are written never touch
+    sqlite at all.
+
+    The buffered items are written at exit, or by `flush`, but lost on a
+    crash. If a write fails, the items stay buffered until the next `put` or
+    `flush` retries the write.
+    Items got from the buffer have no id yet, their `pqid` is None.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        """Initiate a queue in sqlite3 or memory.
+
+        See `SQLiteQueue.__init__` for the parameters, additionally:
+
+        :param buffer_size: the maximum number of buffered items, `put`
+                            writes the buffered items by itself once the
+                            buffer is full.
+        """
+        self.buffer_size = kwargs.pop('buffer_size', 1024)
+        super(SPSCSQLiteQueue, self).__init__(path, *args, **kwargs)
+        if not self.auto_commit:
+            raise ValueError("'SPSCSQLiteQueue' requires auto_commit=True")
+
+    def _init(self):
+        super(SPSCSQLiteQueue, self)._init()
+        # (obj, timestamp) of the items not written yet, appends and pops of
+        # a deque are atomic, so the producer doesn't need a lock.
+        self._buffer = collections.deque()
+        # Held while writing or getting, so the items taken from the buffer
+        # are either all written or none of them, and the order is kept.
+        self._buffer_lock = threading.RLock()
+        self._writer_lock = threading.Lock()
+        self._writer = None
+
+    def put(self, item, block=True, raw=False):
+        """Buffer the item, returns None as its id isn't known yet."""
+        if raw and not isinstance(item, _BLOB_TYPES):
+            # a buffered item which can't be written would block the others
+            raise TypeError(
+                "raw item must be bytes, not '{}'".format(type(item).__name__)
+            )
+        obj = item if raw else self._serializer.dumps(item)
+        self._buffer.append((obj, _time.time()))
+        self._notify_put()
+        if len(self._buffer) >= self.buffer_size:
+            self._write_buffer()
+        else:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_behind)
+                    self._writer.daemon = True
+                    self._writer.start()
+                    _unflushed.add(self)
+
+    def flush(self):
+        """Write all the buffered and the pending put_async items."""
+        self._write_buffer()
+        super(SPSCSQLiteQueue, self).flush()
+
+    def _write_behind(self):
+        """Write the buffered items, exits once the buffer is empty."""
+        while True:
+            with self._writer_lock:
+                if not self._buffer:
+                    self._writer = None
+                    return
+            try:
+                self._write_buffer()
+            except Exception:
+                # the items stay buffered, the next put starts a new writer
+                with self._writer_lock:
+                    self._writer = None
+                log.exception(
+                    'Failed to write the buffered items, retrying on the '
+                    'next put or flush'
+                )
+                return
+
+    def _write_buffer(self):
+        """Write all the buffered items in one transaction.
+
+        If the write fails, the items are put back in the buffer in order
+        and the error is raised.
+        """
+        with self._buffer_lock:
+            entries = []
+            while self._buffer:
+                entries.append(self._buffer.popleft())
+            if not entries:
+                return
+            record = self._record
+            try:
+                self._insert_many(
+                    [record(obj, timestamp) for obj, timestamp in entries],
+                    sql=self._sql_insert_timestamp,
+                )
+            except Exception:
+                self._buffer.extendleft(reversed(entries))
+                raise
+
+    def _pop(self, rowid=None, raw=False):
+        with self._buffer_lock:
+            item = super(SPSCSQLiteQueue, self)._pop(rowid=rowid, raw=raw)
+            if item is not None or rowid is not None or not self._buffer:
+                return item
+            obj, timestamp = self._buffer.popleft()
+            with self._total_lock:
+                self.total -= 1
+        item = self._serializer.loads(obj)
+        if raw:
+            return {'pqid': None, 'data': item, 'timestamp': timestamp}
+        return item
+
+    def get_many(self, n, raw=False):
+        """Get at most n items without blocking, returns a list."""
+        with self._buffer_lock:
+            items = super(SPSCSQLiteQueue, self).get_many(n, raw=raw)
+            while len(items) < n:
+                item = self._pop(raw=raw)
+                if item is None:
+                    break
+                items.append(item)
+        return items
+
+    def _put_many(self, objs):
+        # The buffered items are written first to keep the order
+        with self._buffer_lock:
+            self._write_buffer()
+            return super(SPSCSQLiteQueue, self)._put_many(objs)
+
+    def queue(self):
+        self.flush()
+        return super(SPSCSQLiteQueue, self).queue()
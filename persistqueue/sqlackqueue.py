@@ -3,7 +3,6 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import logging
-import sqlite3
 import time as _time
 import threading
 import warnings
@@ -11,11 +10,10 @@ import warnings
 from . import sqlbase
 from .exceptions import Empty
 
-sqlite3.enable_callback_tracebacks(True)
-
 log = logging.getLogger(__name__)
 
-# 10 seconds internal for `wait` of event
+# 10 seconds at most waiting for a put notification, so records put by
+# other processes are picked up as well
 TICK_FOR_WAIT = 10
 
 
@@ -37,7 +35,7 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
     _SQL_CREATE = (
         'CREATE TABLE IF NOT EXISTS {table_name} ('
         '{key_column} INTEGER PRIMARY KEY AUTOINCREMENT, '
-        'data BLOB, timestamp FLOAT, status INTEGER)'
+        'data BLOB, timestamp INTEGER, status INTEGER)'
     )
     # SQL to insert a record
     _SQL_INSERT = (
@@ -83,17 +81,20 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
         with self.tran_lock:
             with self._putter as tran:
                 tran.execute(sql, (AckStatus.ready, AckStatus.unack,))
-            self.total = self._count()
+            with self._total_lock:
+                self.total = self._count()
 
     def put(self, item):
         obj = self._serializer.dumps(item)
-        _id = self._insert_into(obj, _time.time())
-        self.total += 1
-        self.put_event.set()
+        _id = self._insert_into(obj, self._timestamp())
+        self._notify_put()
         return _id
 
     def _init(self):
         super(SQLiteAckQueue, self)._init()
+        self._sql_mark_ack_status = self._format_sql(
+            self._SQL_MARK_ACK_UPDATE
+        )
         # Action lock to assure multiple action to be *atomic*
         self.action_lock = threading.Lock()
         self.total = self._count()
@@ -172,12 +173,6 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
         sql = """VACUUM"""
         return sql, ()
 
-    @property
-    def _sql_mark_ack_status(self):
-        return self._SQL_MARK_ACK_UPDATE.format(
-            table_name=self._table_name, key_column=self._key_column
-        )
-
     def _pop(self, rowid=None, next_in_order=False, raw=False):
         with self.action_lock:
             row = self._select(next_in_order=next_in_order, rowid=rowid)
@@ -188,9 +183,14 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
                 serialized_data = row[1]
                 item = self._serializer.loads(serialized_data)
                 self._unack_cache[row[0]] = item
-                self.total -= 1
+                with self._total_lock:
+                    self.total -= 1
                 if raw:
-                    return {'pqid': row[0], 'data': item, 'timestamp': row[2]}
+                    return {
+                        'pqid': row[0],
+                        'data': item,
+                        'timestamp': self._seconds(row[2]),
+                    }
                 else:
                     return item
             return None
@@ -254,7 +254,7 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
             self._mark_ack_status(_id, AckStatus.ready)
             if _id in self._unack_cache:
                 self._unack_cache.pop(_id)
-            self.total += 1
+            self._notify_put()
         return _id
 
     def update(self, item, id=None):
@@ -280,40 +280,45 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
             )
         if next_in_order and not isinstance(next_in_order, bool):
             raise ValueError("'next_in_order' must be a boolean (True/False)")
+        # local names for the lookups in the loops below
+        pop = self._pop
+        wait_put = self._wait_put
+        time = _time.time
         if not block:
-            serialized = self._pop(
+            serialized = pop(
                 next_in_order=next_in_order, raw=raw, rowid=rowid
             )
             if serialized is None:
                 raise Empty
         elif timeout is None:
             # block until a put event.
-            serialized = self._pop(
+            seq = self._put_seq
+            serialized = pop(
                 next_in_order=next_in_order, raw=raw, rowid=rowid
             )
             while serialized is None:
-                self.put_event.clear()
-                self.put_event.wait(TICK_FOR_WAIT)
-                serialized = self._pop(
+                seq = wait_put(seq, TICK_FOR_WAIT)
+                serialized = pop(
                     next_in_order=next_in_order, raw=raw, rowid=rowid
                 )
         elif timeout < 0:
             raise ValueError("'timeout' must be a non-negative number")
         else:
             # block until the timeout reached
-            endtime = _time.time() + timeout
-            serialized = self._pop(
+            endtime = time() + timeout
+            seq = self._put_seq
+            serialized = pop(
                 next_in_order=next_in_order, raw=raw, rowid=rowid
             )
             while serialized is None:
-                self.put_event.clear()
-                remaining = endtime - _time.time()
+                remaining = endtime - time()
                 if remaining <= 0.0:
                     raise Empty
-                self.put_event.wait(
+                seq = wait_put(
+                    seq,
                     TICK_FOR_WAIT if TICK_FOR_WAIT < remaining else remaining
                 )
-                serialized = self._pop(
+                serialized = pop(
                     next_in_order=next_in_order, raw=raw, rowid=rowid
                 )
         return serialized
@@ -324,17 +329,17 @@ class SQLiteAckQueue(sqlbase.SQLiteBase):
             self._task_done()
 
     def queue(self):
-        rows = self._sql_queue()
-        datarows = []
-        for row in rows:
-            item = {
+        loads = self._serializer.loads
+        seconds = self._seconds
+        return [
+            {
                 'id': row[0],
-                'data': self._serializer.loads(row[1]),
-                'timestamp': row[2],
+                'data': loads(row[1]),
+                'timestamp': seconds(row[2]),
                 'status': row[3],
             }
-            datarows.append(item)
-        return datarows
+            for row in self._sql_queue()
+        ]
 
     @property
     def size(self):
@@ -373,17 +378,17 @@ class UniqueAckQ(SQLiteAckQueue):
     _SQL_CREATE = (
         'CREATE TABLE IF NOT EXISTS {table_name} ('
         '{key_column} INTEGER PRIMARY KEY AUTOINCREMENT, '
-        'data BLOB, timestamp FLOAT, status INTEGER, UNIQUE (data))'
+        'data BLOB, timestamp INTEGER, status INTEGER, UNIQUE (data))'
+    )
+    # Duplicates are skipped by sqlite, rather than raising IntegrityError
+    _SQL_INSERT = (
+        'INSERT OR IGNORE INTO {table_name} (data, timestamp, status)'
+        ' VALUES (?, ?, %s)' % AckStatus.inited
     )
 
     def put(self, item):
         obj = self._serializer.dumps(item, sort_keys=True)
-        _id = None
-        try:
-            _id = self._insert_into(obj, _time.time())
-        except sqlite3.IntegrityError:
-            pass
-        else:
-            self.total += 1
-            self.put_event.set()
+        _id = self._insert_or_ignore([(obj, self._timestamp())])[0]
+        if _id is not None:
+            self._notify_put()
         return _id
@@ -2,20 +2,23 @@ import logging
 import os
 import sqlite3
 import threading
+import time as _time
 
 import persistqueue.serializers.pickle
 
-sqlite3.enable_callback_tracebacks(True)
-
 log = logging.getLogger(__name__)
 
+# Translating the tracebacks of callbacks is only useful for debugging
+if log.isEnabledFor(logging.DEBUG):
+    sqlite3.enable_callback_tracebacks(True)
+
 
 def with_conditional_transaction(func):
     def _execute(obj, *args, **kwargs):
         with obj.tran_lock:
-            with obj._putter as tran:
+            with obj._putter:
                 stat, param = func(obj, *args, **kwargs)
-                cur = tran.cursor()
+                cur = obj._cursor
                 cur.execute(stat, param)
                 return cur.lastrowid
 
@@ -40,6 +43,18 @@ def commit_ignore_error(conn):
             raise
 
 
+class _GroupedRecord(object):
+    """A record waiting to be committed by `SQLiteBase._insert_grouped`."""
+
+    __slots__ = ('record', 'rowid', 'error', 'done')
+
+    def __init__(self, record):
+        self.record = record
+        self.rowid = None
+        self.error = None
+        self.done = False
+
+
 class SQLiteBase(object):
     """SQLite3 base class."""
 
@@ -52,6 +67,18 @@ class SQLiteBase(object):
     _SQL_SELECT_ID = ''  # SQL to select a record with criteria
     _SQL_SELECT_WHERE = ''  # SQL to select a record with criteria
     _MEMORY = ':memory:'  # flag indicating store DB in memory
+    _FETCH_SIZE = 1000  # rows fetched at once when reading all records
+    # PRAGMAs applied on every new DB connection. WAL lets readers run
+    # concurrently with the writer, and in WAL mode synchronous=NORMAL only
+    # syncs the disk at checkpoints instead of on every commit.
+    _PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+        'cache_size': -64000,
+        'wal_autocheckpoint': 1000,
+    }
 
     def __init__(
         self,
@@ -62,6 +89,7 @@ class SQLiteBase(object):
         auto_commit=True,
         serializer=persistqueue.serializers.pickle,
         db_file_name=None,
+        pragmas=None,
     ):
         """Initiate a queue in sqlite3 or memory.
 
@@ -85,6 +113,9 @@ class SQLiteBase(object):
                            to read multiple values.
         :param db_file_name: set the db file name of the queue data, otherwise
                              default to `data.db`
+        :param pragmas: dict of PRAGMAs to set on the DB connections, which
+                        overrides the defaults in `_PRAGMAS`, a PRAGMA with
+                        value None is not set.
         """
         self.memory_sql = False
         self.path = path
@@ -96,6 +127,9 @@ class SQLiteBase(object):
         self.db_file_name = "data.db"
         if db_file_name:
             self.db_file_name = db_file_name
+        self.pragmas = dict(self._PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
         self._init()
 
     def _init(self):
@@ -108,6 +142,18 @@ class SQLiteBase(object):
             log.debug(
                 'Initializing Sqlite3 Queue with path {}'.format(self.path)
             )
+        # Format the SQL statements only once, which also makes sure the
+        # same SQL string is sent to sqlite3 to reuse its prepared statement.
+        self._sql_create = self._format_sql(self._SQL_CREATE)
+        self._sql_insert = self._format_sql(self._SQL_INSERT)
+        self._sql_update = self._format_sql(self._SQL_UPDATE)
+        self._sql_delete = self._format_sql(
+            'DELETE FROM {table_name} WHERE {key_column} = ?'
+        )
+        self._sql_count = self._format_sql(
+            'SELECT COUNT({key_column}) FROM {table_name}'
+        )
+        self._sql_select_all = self._format_sql('SELECT * FROM {table_name}')
         self._conn = self._new_db_connection(
             self.path, self.multithreading, self.timeout
         )
@@ -116,6 +162,11 @@ class SQLiteBase(object):
 
         self._conn.execute(self._sql_create)
         self._conn.commit()
+        # Timestamps are stored as integer microseconds, whereas tables
+        # created by the older versions store float seconds.
+        self._timestamp_scale = 1
+        if self._column_types().get('timestamp') == 'INTEGER':
+            self._timestamp_scale = 1000000
         # Setup another session only for disk-based queue.
         if self.multithreading:
             if not self.memory_sql:
@@ -124,28 +175,128 @@ class SQLiteBase(object):
                 )
         self._conn.text_factory = str
         self._putter.text_factory = str
+        # Cursor for writes, only used while holding `tran_lock`
+        self._cursor = self._putter.cursor()
 
         # SQLite3 transaction lock
         self.tran_lock = threading.Lock()
-        self.put_event = threading.Event()
+        # Guards updates of the cached record count `total`, which is
+        # maintained in memory so the size never needs a COUNT query.
+        self._total_lock = threading.Lock()
+        # Notified on every put, getters wait on it for new records
+        self._not_empty = threading.Condition(self._total_lock)
+        self._put_seq = 0
+        # Records of the concurrent inserts waiting for a group commit
+        self._commit_barrier = threading.Condition()
+        self._in_txn = False
+        self._batch = []
 
     def _new_db_connection(self, path, multithreading, timeout):
         conn = None
+        # Statements are committed on their own, transactions of multiple
+        # statements are begun explicitly. The access of the connections is
+        # guarded by the locks, so they may be used by any thread.
         if path == self._MEMORY:
-            conn = sqlite3.connect(path, check_same_thread=not multithreading)
+            conn = sqlite3.connect(
+                path, isolation_level=None, check_same_thread=False
+            )
         else:
             conn = sqlite3.connect(
                 '{}/{}'.format(path, self.db_file_name),
                 timeout=timeout,
-                check_same_thread=not multithreading,
+                isolation_level=None,
+                check_same_thread=False,
             )
-        conn.execute('PRAGMA journal_mode=WAL;')
+        for pragma, value in self.pragmas.items():
+            if value is not None:
+                conn.execute('PRAGMA {}={};'.format(pragma, value))
         return conn
 
     @with_conditional_transaction
     def _insert_into(self, *record):
         return self._sql_insert, record
 
+    def _insert_many(self, records, sql=None):
+        """Insert all records in a single transaction.
+
+        Returns the row ids of the inserted records, in order.
+        """
+        if not records:
+            return []
+        with self.tran_lock:
+            with self._putter:
+                cur = self._cursor
+                cur.execute('BEGIN IMMEDIATE')
+                cur.executemany(sql or self._sql_insert, records)
+                # executemany doesn't set lastrowid; rowids of a single
+                # write transaction are consecutive.
+                last = cur.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last - len(records) + 1, last + 1))
+
+    def _insert_or_ignore(self, records, sql=None):
+        """Insert the records in a single transaction, skipping conflicts.
+
+        The insert SQL must skip the conflicting records by itself, e.g.
+        INSERT OR IGNORE. Returns the row ids of the records, None for the
+        skipped ones.
+        """
+        sql = sql or self._sql_insert
+        rowids = []
+        with self.tran_lock:
+            with self._putter:
+                cur = self._cursor
+                cur.execute('BEGIN IMMEDIATE')
+                for record in records:
+                    cur.execute(sql, record)
+                    rowids.append(cur.lastrowid if cur.rowcount > 0 else None)
+        return rowids
+
+    def _insert_grouped(self, *record):
+        """Insert a record, sharing the commit with the concurrent inserts.
+
+        When no commit is in progress, the caller becomes the leader and
+        commits the records of all callers which arrived in the meantime
+        within one transaction, while the others wait for it. Returns the row
+        id of the record.
+        """
+        entry = _GroupedRecord(record)
+        with self._commit_barrier:
+            self._batch.append(entry)
+            while self._in_txn and not entry.done:
+                self._commit_barrier.wait()
+            if not entry.done:
+                self._in_txn = True
+                batch, self._batch = self._batch, []
+        if not entry.done:
+            try:
+                self._commit_batch(batch)
+            finally:
+                with self._commit_barrier:
+                    for grouped in batch:
+                        grouped.done = True
+                    self._in_txn = False
+                    self._commit_barrier.notify_all()
+        if entry.error is not None:
+            raise entry.error
+        return entry.rowid
+
+    def _commit_batch(self, batch):
+        try:
+            rowids = self._insert_many([grouped.record for grouped in batch])
+        except Exception as ex:
+            if len(batch) == 1:
+                batch[0].error = ex
+                return
+            # Insert one by one, so a bad record fails only its own caller
+            for grouped in batch:
+                try:
+                    grouped.rowid = self._insert_many([grouped.record])[0]
+                except Exception as error:
+                    grouped.error = error
+        else:
+            for grouped, rowid in zip(batch, rowids):
+                grouped.rowid = rowid
+
     @with_conditional_transaction
     def _update(self, key, *args):
         args = list(args) + [key]
@@ -153,9 +304,12 @@ class SQLiteBase(object):
 
     @with_conditional_transaction
     def _delete(self, key, op='='):
-        sql = 'DELETE FROM {} WHERE {} {} ?'.format(
-            self._table_name, self._key_column, op
-        )
+        if op == '=':
+            sql = self._sql_delete
+        else:
+            sql = 'DELETE FROM {} WHERE {} {} ?'.format(
+                self._table_name, self._key_column, op
+            )
         return sql, (key,)
 
     def _select(self, *args, **kwargs):
@@ -192,25 +346,70 @@ class SQLiteBase(object):
         return result
 
     def _count(self):
-        sql = 'SELECT COUNT({}) FROM {}'.format(
-            self._key_column, self._table_name
-        )
-        row = self._getter.execute(sql).fetchone()
+        row = self._getter.execute(self._sql_count).fetchone()
         return row[0] if row else 0
 
+    def _column_types(self):
+        """Map the column names of the table to their declared types."""
+        sql = 'PRAGMA table_info({})'.format(self._table_name)
+        return {row[1]: row[2].upper() for row in self._conn.execute(sql)}
+
+    def _column_defaults(self):
+        """Map the column names of the table to their default values."""
+        sql = 'PRAGMA table_info({})'.format(self._table_name)
+        return {row[1]: row[4] for row in self._conn.execute(sql)}
+
+    def _timestamp(self, seconds=None):
+        """Convert seconds, by default now, to the stored timestamp."""
+        if seconds is None:
+            seconds = _time.time()
+        if self._timestamp_scale == 1:
+            return seconds
+        return int(seconds * self._timestamp_scale)
+
+    def _seconds(self, timestamp):
+        """Convert a stored timestamp to seconds since the epoch."""
+        if timestamp is None or self._timestamp_scale == 1:
+            return timestamp
+        return float(timestamp) / self._timestamp_scale
+
     def _start_key(self):
         if self._TABLE_NAME == 'ack_filo_queue':
             return 9223372036854775807  # maxsize
         else:
             return 0
 
+    def _notify_put(self, count=1):
+        """Count the new records and wake up the getters waiting for them."""
+        with self._not_empty:
+            self.total += count
+            self._put_seq += 1
+            self._not_empty.notify(count)
+
+    def _wait_put(self, seq, timeout):
+        """Wait for a put after the `seq` snapshot of `_put_seq`.
+
+        Returns immediately if a put already happened since the snapshot,
+        so a put between the snapshot and the wait is never missed.
+        Returns the current `_put_seq`.
+        """
+        with self._not_empty:
+            if self._put_seq == seq:
+                self._not_empty.wait(timeout)
+            return self._put_seq
+
     def _task_done(self):
         """Only required if auto-commit is set as False."""
         commit_ignore_error(self._putter)
 
     def _sql_queue(self):
-        sql = 'SELECT * FROM {}'.format(self._table_name)
-        return self._getter.execute(sql)
+        """Iterate over all the records, in batches of `_FETCH_SIZE`."""
+        cur = self._getter.execute(self._sql_select_all)
+        rows = cur.fetchmany(self._FETCH_SIZE)
+        while rows:
+            for row in rows:
+                yield row
+            rows = cur.fetchmany(self._FETCH_SIZE)
 
     @property
     def _table_name(self):
@@ -220,45 +419,22 @@ class SQLiteBase(object):
     def _key_column(self):
         return self._KEY_COLUMN
 
-    @property
-    def _sql_create(self):
-        return self._SQL_CREATE.format(
-            table_name=self._table_name, key_column=self._key_column
-        )
-
-    @property
-    def _sql_insert(self):
-        return self._SQL_INSERT.format(
-            table_name=self._table_name, key_column=self._key_column
-        )
-
-    @property
-    def _sql_update(self):
-        return self._SQL_UPDATE.format(
-            table_name=self._table_name, key_column=self._key_column
-        )
-
-    def _sql_select_id(self, rowid):
-        return self._SQL_SELECT_ID.format(
+    def _format_sql(self, sql, **kwargs):
+        return sql.format(
             table_name=self._table_name,
             key_column=self._key_column,
-            rowid=rowid,
+            **kwargs
         )
 
+    def _sql_select_id(self, rowid):
+        return self._format_sql(self._SQL_SELECT_ID, rowid=rowid)
+
     def _sql_select(self, rowid):
-        return self._SQL_SELECT.format(
-            table_name=self._table_name,
-            key_column=self._key_column,
-            rowid=rowid,
-        )
+        return self._format_sql(self._SQL_SELECT, rowid=rowid)
 
     def _sql_select_where(self, rowid, op, column):
-        return self._SQL_SELECT_WHERE.format(
-            table_name=self._table_name,
-            key_column=self._key_column,
-            rowid=rowid,
-            op=op,
-            column=column,
+        return self._format_sql(
+            self._SQL_SELECT_WHERE, rowid=rowid, op=op, column=column
         )
 
     def __del__(self):
@@ -2,35 +2,82 @@
 
 """A thread-safe sqlite3 based persistent queue in Python."""
 
+import atexit
+import collections
+import hashlib
 import logging
 import sqlite3
+import struct
 import time as _time
 import threading
+import weakref
+
+try:
+    from concurrent.futures import Future
+except ImportError:  # python2 without the futures backport
+    Future = None
 
 from persistqueue import sqlbase
 from persistqueue.exceptions import Empty
 
-sqlite3.enable_callback_tracebacks(True)
-
 log = logging.getLogger(__name__)
 
-# 10 seconds internal for `wait` of event
+# DELETE ... RETURNING is supported since sqlite 3.35.0
+_SQL_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# The current unix time in microseconds, julianday('now') is in milliseconds
+# precision.
+_SQL_NOW = "CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER)"
+
+# 10 seconds at most waiting for a put notification, so records put by
+# other processes are picked up as well
 TICK_FOR_WAIT = 10
 
 
+# Queues which may have items not written yet by a background writer
+_unflushed = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit():
+    """Write the pending items before the writer threads are killed."""
+    for queue in list(_unflushed):
+        try:
+            queue.flush()
+        except Exception:
+            log.exception('Failed to flush the queue at exit')
+
+
+def _data_hash(obj):
+    """Return a hash of the serialized data, stable across processes."""
+    if isinstance(obj, type(u'')):
+        # raw items may be text
+        obj = obj.encode('utf-8')
+    return struct.unpack('<q', hashlib.sha1(obj).digest()[:8])[0]
+
+
 class SQLiteQueue(sqlbase.SQLiteBase):
     """SQLite3 based FIFO queue."""
 
     _TABLE_NAME = 'queue'
     _KEY_COLUMN = '_id'  # the name of the key column, used in DB CRUD
     # SQL to create a table
+    # Without AUTOINCREMENT, sqlite doesn't update sqlite_sequence on every
+    # insert. Rowids are still increasing, but may be reused once the
+    # table is empty.
+    # The timestamp defaults to the current time in microseconds, filled in
+    # by sqlite.
     _SQL_CREATE = (
         'CREATE TABLE IF NOT EXISTS {table_name} ('
-        '{key_column} INTEGER PRIMARY KEY AUTOINCREMENT, '
-        'data BLOB, timestamp FLOAT)'
+        '{key_column} INTEGER PRIMARY KEY{autoincrement}, '
+        'data BLOB, timestamp INTEGER DEFAULT (' + _SQL_NOW + '))'
     )
     # SQL to insert a record
-    _SQL_INSERT = 'INSERT INTO {table_name} (data, timestamp) VALUES (?, ?)'
+    _SQL_INSERT = 'INSERT INTO {table_name} (data) VALUES (?)'
+    # SQL to insert a record with the given timestamp
+    _SQL_INSERT_TIMESTAMP = (
+        'INSERT INTO {table_name} (data, timestamp) VALUES (?, ?)'
+    )
     # SQL to select a record
     _SQL_SELECT_ID = (
         'SELECT {key_column}, data, timestamp FROM {table_name} WHERE'
@@ -44,23 +91,162 @@ class SQLiteQueue(sqlbase.SQLiteBase):
         'SELECT {key_column}, data, timestamp FROM {table_name} WHERE'
         ' {column} {op} ? ORDER BY {key_column} ASC LIMIT 1 '
     )
+    # SQL to select the next records after the cursor
+    _SQL_SELECT_AFTER = (
+        'SELECT {key_column}, data, timestamp FROM {table_name} WHERE'
+        ' {key_column} > ? ORDER BY {key_column} ASC LIMIT ?'
+    )
     _SQL_UPDATE = 'UPDATE {table_name} SET data = ? WHERE {key_column} = ?'
+    # SQL to delete and return the next record
+    _SQL_POP = (
+        'DELETE FROM {table_name} WHERE {key_column} = ('
+        'SELECT {key_column} FROM {table_name} '
+        'ORDER BY {key_column} ASC LIMIT 1) '
+        'RETURNING {key_column}, data, timestamp'
+    )
+    _SQL_POP_MANY = (
+        'DELETE FROM {table_name} WHERE {key_column} IN ('
+        'SELECT {key_column} FROM {table_name} '
+        'ORDER BY {key_column} ASC LIMIT ?) '
+        'RETURNING {key_column}, data, timestamp'
+    )
+    _DESCENDING = False  # whether records are got in descending id order
+    _PREFETCH_SIZE = 64  # records read ahead at once if auto_commit=False
+
+    def __init__(self, path, *args, **kwargs):
+        """Initiate a queue in sqlite3 or memory.
+
+        See `SQLiteBase.__init__` for the parameters, additionally:
 
-    def put(self, item, block=True):
+        :param strict_ordering: if set to True, the table is created with
+                                AUTOINCREMENT, so ids are never reused, even
+                                after the queue has been emptied.
+        """
+        self.strict_ordering = kwargs.pop('strict_ordering', False)
+        super(SQLiteQueue, self).__init__(path, *args, **kwargs)
+
+    def put(self, item, block=True, raw=False, timestamp=None):
         # block kwarg is noop and only here to align with python's queue
-        obj = self._serializer.dumps(item)
-        _id = self._insert_into(obj, _time.time())
-        self.total += 1
-        self.put_event.set()
+        # raw=True means item is bytes already dumped by the serializer,
+        # which are stored as they are.
+        # timestamp in seconds since the epoch overrides the current time,
+        # e.g. when replaying records.
+        obj = item if raw else self._serializer.dumps(item)
+        if timestamp is None:
+            _id = self._insert_grouped(*self._record(obj))
+        else:
+            _id = self._insert_many(
+                [self._record(obj, timestamp)], sql=self._sql_insert_timestamp
+            )[0]
+        self._notify_put()
         return _id
 
     def put_nowait(self, item):
         return self.put(item, block=False)
 
+    def put_many(self, items):
+        """Put all items within one transaction, returns their ids."""
+        dumps = self._serializer.dumps
+        return self._put_many([dumps(item) for item in items])
+
+    def _put_many(self, objs):
+        """Insert the serialized objs in one transaction."""
+        record = self._record
+        ids = self._insert_many([record(obj) for obj in objs])
+        if ids:
+            self._notify_put(len(ids))
+        return ids
+
+    def put_async(self, item, raw=False):
+        """Put item via a background writer thread, returns a Future.
+
+        The item is serialized by the calling thread, and the writer thread
+        inserts all the pending items in a single transaction. The result of
+        the future is the id of the item. The pending items are written at
+        exit, or by `flush`.
+        """
+        if Future is None:
+            raise NotImplementedError(
+                "'put_async' requires concurrent.futures, install the "
+                "'futures' backport on python2"
+            )
+        obj = item if raw else self._serializer.dumps(item)
+        future = Future()
+        with self._async_lock:
+            self._async_pending.append((obj, future))
+            if self._async_writer is None:
+                self._async_writer = threading.Thread(
+                    target=self._write_async
+                )
+                self._async_writer.daemon = True
+                self._async_writer.start()
+                _unflushed.add(self)
+        return future
+
+    def flush(self):
+        """Wait until the pending items of put_async are written."""
+        while True:
+            with self._async_lock:
+                writer = self._async_writer
+            if writer is None or writer is threading.current_thread():
+                return
+            writer.join()
+
+    def _write_async(self):
+        """Write the pending items of put_async, exits once drained."""
+        while True:
+            with self._async_lock:
+                batch = self._async_pending
+                if not batch:
+                    self._async_writer = None
+                    return
+                self._async_pending = []
+            try:
+                ids = self._put_many([obj for obj, _ in batch])
+            except Exception as ex:
+                for _, future in batch:
+                    future.set_exception(ex)
+            else:
+                for (_, future), _id in zip(batch, ids):
+                    future.set_result(_id)
+
+    def _record(self, obj, timestamp=None):
+        """Return the parameters of the insert SQL.
+
+        The timestamp is left to sqlite unless it's given, or the table is
+        created by an older version without the default timestamp.
+        """
+        if timestamp is None and self._db_timestamp:
+            return (obj,)
+        return obj, self._timestamp(timestamp)
+
+    def _format_sql(self, sql, **kwargs):
+        kwargs.setdefault(
+            'autoincrement', ' AUTOINCREMENT' if self.strict_ordering else ''
+        )
+        return super(SQLiteQueue, self)._format_sql(sql, **kwargs)
+
     def _init(self):
         super(SQLiteQueue, self)._init()
+        self._sql_insert_timestamp = self._format_sql(
+            self._SQL_INSERT_TIMESTAMP
+        )
+        self._db_timestamp = (
+            self._column_defaults().get('timestamp') is not None
+        )
+        if not self._db_timestamp:
+            self._sql_insert = self._sql_insert_timestamp
+        self._sql_pop = self._format_sql(self._SQL_POP)
+        self._sql_pop_many = self._format_sql(self._SQL_POP_MANY)
+        # Items of put_async waiting for the writer thread
+        self._async_lock = threading.Lock()
+        self._async_pending = []
+        self._async_writer = None
         # Action lock to assure multiple action to be *atomic*
         self.action_lock = threading.Lock()
+        # Records after the cursor read ahead if auto_commit=False
+        self._sql_select_after = self._format_sql(self._SQL_SELECT_AFTER)
+        self._prefetch = collections.deque()
         if not self.auto_commit:
             # Refresh current cursor after restart
             head = self._select()
@@ -73,40 +259,109 @@ class SQLiteQueue(sqlbase.SQLiteBase):
     def _pop(self, rowid=None, raw=False):
         with self.action_lock:
             if self.auto_commit:
-                row = self._select(rowid=rowid)
-                # Perhaps a sqlite3 bug, sometimes (None, None) is returned
-                # by select, below can avoid these invalid records.
+                if rowid is None and _SQL_RETURNING:
+                    row = self._delete_next()
+                else:
+                    row = self._select(rowid=rowid)
+                    # Perhaps a sqlite3 bug, sometimes (None, None) is
+                    # returned by select, below can avoid these invalid
+                    # records.
+                    if row and row[0] is not None:
+                        self._delete(row[0])
                 if row and row[0] is not None:
-                    self._delete(row[0])
-                    self.total -= 1
+                    with self._total_lock:
+                        self.total -= 1
                     item = self._serializer.loads(row[1])
                     if raw:
                         return {
                             'pqid': row[0],
                             'data': item,
-                            'timestamp': row[2],
+                            'timestamp': self._seconds(row[2]),
                         }
                     else:
                         return item
             else:
-                row = self._select(
-                    self.cursor, op=">", column=self._KEY_COLUMN, rowid=rowid
-                )
+                if rowid is None:
+                    row = self._next_prefetched()
+                else:
+                    # the cursor moves to the given record
+                    self._prefetch.clear()
+                    row = self._select(rowid=rowid)
                 if row and row[0] is not None:
                     self.cursor = row[0]
-                    self.total -= 1
+                    with self._total_lock:
+                        self.total -= 1
                     item = self._serializer.loads(row[1])
                     if raw:
                         return {
                             'pqid': row[0],
                             'data': item,
-                            'timestamp': row[2],
+                            'timestamp': self._seconds(row[2]),
                         }
                     else:
                         return item
             return None
 
-    def update(self, item, id=None):
+    def _next_prefetched(self):
+        """Return the next record after the cursor, read ahead in batches.
+
+        The records got are only deleted by task_done, so the read ahead
+        records stay valid until then.
+        """
+        if not self._prefetch:
+            self._prefetch.extend(self._getter.execute(
+                self._sql_select_after, (self.cursor, self._PREFETCH_SIZE)
+            ))
+        return self._prefetch.popleft() if self._prefetch else None
+
+    def _delete_next(self):
+        """Delete the next record and return it, in a single statement."""
+        with self.tran_lock:
+            with self._putter:
+                # fetch all to run the statement to completion before commit
+                rows = self._cursor.execute(self._sql_pop).fetchall()
+        return rows[0] if rows else None
+
+    def get_many(self, n, raw=False):
+        """Get at most n items without blocking, returns a list."""
+        if n <= 0:
+            return []
+        if not self.auto_commit or not _SQL_RETURNING:
+            items = []
+            while len(items) < n:
+                item = self._pop(raw=raw)
+                if item is None:
+                    break
+                items.append(item)
+            return items
+        with self.action_lock:
+            with self.tran_lock:
+                with self._putter:
+                    rows = self._cursor.execute(
+                        self._sql_pop_many, (n,)
+                    ).fetchall()
+            rows = [row for row in rows if row[0] is not None]
+            with self._total_lock:
+                self.total -= len(rows)
+        # the order of RETURNING rows is undefined
+        rows.sort(reverse=self._DESCENDING)
+        loads = self._serializer.loads
+        if raw:
+            seconds = self._seconds
+            return [
+                {
+                    'pqid': row[0],
+                    'data': loads(row[1]),
+                    'timestamp': seconds(row[2]),
+                }
+                for row in rows
+            ]
+        return [loads(row[1]) for row in rows]
+
+    @staticmethod
+    def _update_args(item, id):
+        """Return the id and the data of an update."""
+        _id = None
         if isinstance(item, dict) and "pqid" in item:
             _id = item.get("pqid")
             item = item.get("data")
@@ -114,8 +369,14 @@ class SQLiteQueue(sqlbase.SQLiteBase):
             _id = id
         if _id is None:
             raise ValueError("Provide an id or raw item")
+        return _id, item
+
+    def update(self, item, id=None):
+        _id, item = self._update_args(item, id)
         obj = self._serializer.dumps(item)
-        self._update(_id, obj)
+        with self.action_lock:
+            self._update(_id, obj)
+            self._prefetch.clear()
         return _id
 
     def get(self, block=True, timeout=None, id=None, raw=False):
@@ -125,32 +386,37 @@ class SQLiteQueue(sqlbase.SQLiteBase):
             rowid = id
         else:
             rowid = None
+        # local names for the lookups in the loops below
+        pop = self._pop
+        wait_put = self._wait_put
+        time = _time.time
         if not block:
-            serialized = self._pop(raw=raw, rowid=rowid)
+            serialized = pop(raw=raw, rowid=rowid)
             if serialized is None:
                 raise Empty
         elif timeout is None:
             # block until a put event.
-            serialized = self._pop(raw=raw, rowid=rowid)
+            seq = self._put_seq
+            serialized = pop(raw=raw, rowid=rowid)
             while serialized is None:
-                self.put_event.clear()
-                self.put_event.wait(TICK_FOR_WAIT)
-                serialized = self._pop(raw=raw, rowid=rowid)
+                seq = wait_put(seq, TICK_FOR_WAIT)
+                serialized = pop(raw=raw, rowid=rowid)
         elif timeout < 0:
             raise ValueError("'timeout' must be a non-negative number")
         else:
             # block until the timeout reached
-            endtime = _time.time() + timeout
-            serialized = self._pop(raw=raw, rowid=rowid)
+            endtime = time() + timeout
+            seq = self._put_seq
+            serialized = pop(raw=raw, rowid=rowid)
             while serialized is None:
-                self.put_event.clear()
-                remaining = endtime - _time.time()
+                remaining = endtime - time()
                 if remaining <= 0.0:
                     raise Empty
-                self.put_event.wait(
+                seq = wait_put(
+                    seq,
                     TICK_FOR_WAIT if TICK_FOR_WAIT < remaining else remaining
                 )
-                serialized = self._pop(raw=raw, rowid=rowid)
+                serialized = pop(raw=raw, rowid=rowid)
         return serialized
 
     def get_nowait(self, id=None, raw=False):
@@ -159,20 +425,21 @@ class SQLiteQueue(sqlbase.SQLiteBase):
     def task_done(self):
         """Persist the current state if auto_commit=False."""
         if not self.auto_commit:
-            self._delete(self.cursor, op='<=')
-            self._task_done()
+            with self.action_lock:
+                self._delete(self.cursor, op='<=')
+                self._task_done()
+                self._prefetch.clear()
+                # All the remaining records are not got yet, and rowids
+                # below the cursor are reused once the table is empty.
+                self.cursor = 0
 
     def queue(self):
-        rows = self._sql_queue()
-        datarows = []
-        for row in rows:
-            item = {
-                'id': row[0],
-                'data': self._serializer.loads(row[1]),
-                'timestamp': row[2],
-            }
-            datarows.append(item)
-        return datarows
+        loads = self._serializer.loads
+        seconds = self._seconds
+        return [
+            {'id': row[0], 'data': loads(row[1]), 'timestamp': seconds(row[2])}
+            for row in self._sql_queue()
+        ]
 
     @property
     def size(self):
@@ -197,27 +464,150 @@ class FILOSQLiteQueue(SQLiteQueue):
     _TABLE_NAME = 'filo_queue'
     # SQL to select a record
     _SQL_SELECT = (
-        'SELECT {key_column}, data FROM {table_name} '
+        'SELECT {key_column}, data, timestamp FROM {table_name} '
         'ORDER BY {key_column} DESC LIMIT 1'
     )
+    _SQL_POP = (
+        'DELETE FROM {table_name} WHERE {key_column} = ('
+        'SELECT {key_column} FROM {table_name} '
+        'ORDER BY {key_column} DESC LIMIT 1) '
+        'RETURNING {key_column}, data, timestamp'
+    )
+    _SQL_POP_MANY = (
+        'DELETE FROM {table_name} WHERE {key_column} IN ('
+        'SELECT {key_column} FROM {table_name} '
+        'ORDER BY {key_column} DESC LIMIT ?) '
+        'RETURNING {key_column}, data, timestamp'
+    )
+    _DESCENDING = True
 
 
 class UniqueQ(SQLiteQueue):
     _TABLE_NAME = 'unique_queue'
+    # Duplicates are found via the index of the data hash, which is much
+    # smaller and faster to compare than a unique index of the data itself.
     _SQL_CREATE = (
         'CREATE TABLE IF NOT EXISTS {table_name} ('
-        '{key_column} INTEGER PRIMARY KEY AUTOINCREMENT, '
-        'data BLOB, timestamp FLOAT, UNIQUE (data))'
+        '{key_column} INTEGER PRIMARY KEY{autoincrement}, '
+        'data BLOB, timestamp INTEGER DEFAULT (' + _SQL_NOW + '), '
+        'data_hash INTEGER)'
+    )
+    _SQL_CREATE_INDEX = (
+        'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} (data_hash)'
+    )
+    # The data is compared as well in case of a hash collision
+    _SQL_INSERT = (
+        'INSERT INTO {table_name} (data, data_hash) '
+        'SELECT ?, ? WHERE NOT EXISTS ('
+        'SELECT 1 FROM {table_name} WHERE data_hash = ? AND data = ?)'
+    )
+    _SQL_INSERT_TIMESTAMP = (
+        'INSERT INTO {table_name} (data, data_hash, timestamp) '
+        'SELECT ?, ?, ? WHERE NOT EXISTS ('
+        'SELECT 1 FROM {table_name} WHERE data_hash = ? AND data = ?)'
+    )
+    _SQL_UPDATE_HASHED = (
+        'UPDATE {table_name} SET data = ?, data_hash = ? '
+        'WHERE {key_column} = ?'
+    )
+    _SQL_SELECT_DUPLICATE = (
+        'SELECT {key_column} FROM {table_name} '
+        'WHERE data_hash = ? AND data = ? AND {key_column} != ?'
+    )
+    # SQL to insert into tables with UNIQUE (data) of the older versions
+    _SQL_INSERT_UNIQUE_DATA = (
+        'INSERT OR IGNORE INTO {table_name} (data, timestamp) VALUES (?, ?)'
     )
 
-    def put(self, item):
-        obj = self._serializer.dumps(item, sort_keys=True)
-        _id = None
-        try:
-            _id = self._insert_into(obj, _time.time())
-        except sqlite3.IntegrityError:
-            pass
+    def _init(self):
+        super(UniqueQ, self)._init()
+        self._hashed = 'data_hash' in self._column_types()
+        if self._hashed:
+            self._conn.execute(self._format_sql(
+                self._SQL_CREATE_INDEX,
+                index_name='`{}_{}_data_hash`'.format(
+                    self._TABLE_NAME, self.name
+                ),
+            ))
+            self._conn.commit()
+            self._sql_update = self._format_sql(self._SQL_UPDATE_HASHED)
+            self._sql_select_duplicate = self._format_sql(
+                self._SQL_SELECT_DUPLICATE
+            )
         else:
-            self.total += 1
-            self.put_event.set()
+            self._sql_insert = self._format_sql(self._SQL_INSERT_UNIQUE_DATA)
+            self._sql_insert_timestamp = self._sql_insert
+
+    def _record(self, obj, timestamp=None):
+        """Return the parameters of the insert SQL."""
+        if not self._hashed:
+            return obj, self._timestamp(timestamp)
+        data_hash = _data_hash(obj)
+        if timestamp is None and self._db_timestamp:
+            return obj, data_hash, data_hash, obj
+        return obj, data_hash, self._timestamp(timestamp), data_hash, obj
+
+    def put(self, item, raw=False, timestamp=None):
+        if raw:
+            obj = item
+        else:
+            obj = self._serializer.dumps(item, sort_keys=True)
+        if timestamp is None:
+            _id = self._insert_or_ignore([self._record(obj)])[0]
+        else:
+            _id = self._insert_or_ignore(
+                [self._record(obj, timestamp)], sql=self._sql_insert_timestamp
+            )[0]
+        if _id is not None:
+            self._notify_put()
         return _id
+
+    def update(self, item, id=None):
+        """Update the data of an item, returns its id.
+
+        Raises sqlite3.IntegrityError if the data is a duplicate of another
+        item, like the UNIQUE (data) tables of the older versions.
+        """
+        if not self._hashed:
+            return super(UniqueQ, self).update(item, id=id)
+        _id, item = self._update_args(item, id)
+        obj = self._serializer.dumps(item, sort_keys=True)
+        data_hash = _data_hash(obj)
+        with self.action_lock:
+            with self.tran_lock:
+                with self._putter:
+                    cur = self._cursor
+                    cur.execute('BEGIN IMMEDIATE')
+                    duplicate = cur.execute(
+                        self._sql_select_duplicate, (data_hash, obj, _id)
+                    ).fetchone()
+                    if duplicate:
+                        raise sqlite3.IntegrityError(
+                            'UNIQUE constraint failed: {}.data'.format(
+                                self._table_name
+                            )
+                        )
+                    cur.execute(self._sql_update, (obj, data_hash, _id))
+            self._prefetch.clear()
+        return _id
+
+    def put_many(self, items):
+        """Put all items within one transaction, returns their ids.
+
+        The id of an item is None if it's a duplicate.
+        """
+        dumps = self._serializer.dumps
+        return self._put_many([dumps(item, sort_keys=True) for item in items])
+
+    def _put_many(self, objs):
+        record = self._record
+        ids = self._insert_or_ignore([record(obj) for obj in objs])
+        added = len(ids) - ids.count(None)
+        if added:
+            self._notify_put(added)
+        return ids
+
+    def put_async(self, item, raw=False):
+        if not raw:
+            item = self._serializer.dumps(item, sort_keys=True)
+        return super(UniqueQ, self).put_async(item, raw=True)
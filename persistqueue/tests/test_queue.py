@@ -15,6 +15,11 @@ from persistqueue.serializers import json as serializers_json
 from persistqueue.serializers import pickle as serializers_pickle
 from persistqueue.serializers import msgpack as serializers_msgpack
 
+try:
+    from persistqueue.serializers import msgspec as serializers_msgspec
+except ImportError:
+    serializers_msgspec = None
+
 from persistqueue import Queue, Empty, Full
 
 # map keys as params for readable errors from nose
@@ -24,6 +29,9 @@ serializer_params = {
     "serializer=msgpack": {"serializer": serializers_msgpack},
     "serializer=pickle": {"serializer": serializers_pickle},
 }
+if serializers_msgspec is not None:
+    serializer_params["serializer=msgspec"] = {
+        "serializer": serializers_msgspec}
 
 
 class PersistTest(unittest.TestCase):
@@ -0,0 +1,169 @@
+# coding=utf-8
+
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from persistqueue import SPSCSQLiteQueue
+from persistqueue import Empty
+from persistqueue import sqlqueue
+
+
+class SPSCSQLiteQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix='spsc')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_put_get(self):
+        q = SPSCSQLiteQueue(self.path)
+        self.assertIsNone(q.put('var1'))
+        q.put('var2')
+        self.assertEqual(2, q.qsize())
+        self.assertEqual('var1', q.get())
+        self.assertEqual('var2', q.get())
+        self.assertEqual(0, q.qsize())
+        self.assertRaises(Empty, q.get, block=False)
+        self.assertRaises(Empty, q.get, timeout=0.1)
+
+    def test_flush(self):
+        q = SPSCSQLiteQueue(self.path)
+        for i in range(10):
+            q.put('var%d' % i)
+        q.flush()
+        self.assertEqual(0, len(q._buffer))
+        del q
+        q = SPSCSQLiteQueue(self.path)
+        self.assertEqual(10, q.qsize())
+        for i in range(10):
+            self.assertEqual('var%d' % i, q.get())
+
+    def test_flush_at_exit(self):
+        q = SPSCSQLiteQueue(self.path)
+        q.put('var1')
+        q.put_async('var2')
+        self.assertIn(q, sqlqueue._unflushed)
+        sqlqueue._flush_at_exit()
+        self.assertEqual(0, len(q._buffer))
+        self.assertEqual(2, q._count())
+
+    def test_write_error(self):
+        """Test the items stay buffered in order if the write fails."""
+        q = SPSCSQLiteQueue(self.path)
+        q.put('var1')
+        q.flush()
+        insert_many = q._insert_many
+
+        def locked(*args, **kwargs):
+            raise sqlite3.OperationalError('database is locked')
+
+        q._insert_many = locked
+        q.put('var2')
+        q.put('var3')
+        self.assertRaises(sqlite3.OperationalError, q.flush)
+        self.assertEqual(3, q.qsize())
+        q._insert_many = insert_many
+        q.put('var4')
+        q.flush()
+        self.assertEqual(['var1', 'var2', 'var3', 'var4'],
+                         [item['data'] for item in q.queue()])
+
+    def test_writer_error(self):
+        """Test a new writer is started after the writer failed."""
+        q = SPSCSQLiteQueue(self.path)
+        insert_many = q._insert_many
+
+        def out_of_memory(*args, **kwargs):
+            raise MemoryError()
+
+        q._insert_many = out_of_memory
+        q.put('var1')
+        self._join_writer(q)
+        self.assertIsNone(q._writer)
+        self.assertEqual(1, len(q._buffer))
+        q._insert_many = insert_many
+        q.put('var2')
+        self._join_writer(q)
+        self.assertEqual(2, q._count())
+
+    def _join_writer(self, q):
+        writer = q._writer
+        if writer is not None:
+            writer.join()
+
+    def test_put_raw(self):
+        q = SPSCSQLiteQueue(self.path)
+        self.assertRaises(TypeError, q.put, object(), raw=True)
+        self.assertEqual(0, q.qsize())
+        q.put(q._serializer.dumps('var'), raw=True)
+        self.assertEqual('var', q.get())
+
+    def test_order(self):
+        """Test the items written and the buffered ones are got in order."""
+        q = SPSCSQLiteQueue(self.path, buffer_size=16)
+        for i in range(100):
+            q.put(i)
+        q.put_many(range(100, 150))
+        for i in range(150, 200):
+            q.put(i)
+        self.assertEqual(list(range(200)), q.get_many(200))
+        self.assertEqual(0, q.qsize())
+
+    def test_raw(self):
+        q = SPSCSQLiteQueue(self.path)
+        now = time.time()
+        q.put('var1')
+        q.put('var2')
+        q.flush()
+        q.put('var3')
+        item = q.get(raw=True)
+        self.assertIsNotNone(item['pqid'])
+        self.assertEqual('var1', item['data'])
+        self.assertAlmostEqual(now, item['timestamp'], delta=5)
+        self.assertEqual(['var2', 'var3'],
+                         [item['data'] for item in q.get_many(2, raw=True)])
+
+    def test_queue(self):
+        q = SPSCSQLiteQueue(self.path)
+        q.put('var1')
+        q.put('var2')
+        self.assertEqual(['var1', 'var2'],
+                         [item['data'] for item in q.queue()])
+
+    def test_auto_commit(self):
+        self.assertRaises(ValueError, SPSCSQLiteQueue, self.path,
+                          auto_commit=False)
+
+    def test_producer_consumer(self):
+        q = SPSCSQLiteQueue(self.path, multithreading=True)
+        result = []
+
+        def producer():
+            for i in range(1000):
+                q.put(i)
+
+        def consumer():
+            for _ in range(1000):
+                result.append(q.get())
+
+        threads = [Thread(target=producer), Thread(target=consumer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(list(range(1000)), result)
+        self.assertEqual(0, q.qsize())
+        q.flush()
+        self.assertEqual(0, q._count())
+
+
+class SPSCSQLiteQueueInMemory(SPSCSQLiteQueueTest):
+    def setUp(self):
+        self.path = ':memory:'
+
+    def test_flush(self):
+        self.skipTest('Memory based sqlite is not persistent.')
@@ -1,8 +1,12 @@
 # coding=utf-8
 
+import os
+import pickle
 import random
 import shutil
+import sqlite3
 import sys
+import time
 import tempfile
 import unittest
 from threading import Thread
@@ -495,3 +499,19 @@ class SQLite3UniqueAckQueueTest(SQLite3AckQueueTest):
         del q
         q = self.queue_class(self.path)
         self.assertEqual(2, q.size)
+
+    def test_legacy_unique_data_protocol_4(self):
+        """Test duplicates of the items put by the older versions."""
+        conn = sqlite3.connect(os.path.join(self.path, 'data.db'))
+        conn.execute(
+            'CREATE TABLE `ack_unique_queue_default` ('
+            '_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'data BLOB, timestamp FLOAT, status INTEGER, UNIQUE (data))')
+        conn.execute(
+            'INSERT INTO `ack_unique_queue_default` (data, timestamp, status) '
+            'VALUES (?, ?, 1)', (pickle.dumps('u1', protocol=4), time.time()))
+        conn.commit()
+        conn.close()
+        q = self.queue_class(self.path)
+        self.assertIsNone(q.put('u1'))
+        self.assertEqual(['u1'], [item['data'] for item in q.queue()])
@@ -1,18 +1,28 @@
 # coding=utf-8
 
+import os
+import pickle
 import random
 import shutil
+import sqlite3
 import sys
 import tempfile
+import time
 import unittest
 from threading import Thread
 
 from persistqueue import SQLiteQueue, FILOSQLiteQueue, UniqueQ
+from persistqueue import sqlqueue
 from persistqueue import Empty
 from persistqueue.serializers import json as serializers_json
 from persistqueue.serializers import pickle as serializers_pickle
 from persistqueue.serializers import msgpack as serializers_msgpack
 
+try:
+    from persistqueue.serializers import msgspec as serializers_msgspec
+except ImportError:
+    serializers_msgspec = None
+
 
 class SQLite3QueueTest(unittest.TestCase):
     def setUp(self):
@@ -37,6 +47,25 @@ class SQLite3QueueTest(unittest.TestCase):
         self.assertRaises(ValueError, q.get, block=True, timeout=-1.0)
         del q
 
+    def test_get_wakes_up_on_put(self):
+        q = SQLiteQueue(self.path, auto_commit=self.auto_commit,
+                        multithreading=True)
+        result = []
+
+        def consumer():
+            result.append(q.get())
+
+        c = Thread(target=consumer)
+        c.start()
+        time.sleep(0.1)
+        start = time.time()
+        q.put('first')
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        # woken up by the put, not by the periodic wake up
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(['first'], result)
+
     def test_empty(self):
         q = SQLiteQueue(self.path, auto_commit=self.auto_commit)
         self.assertEqual(q.empty(), True)
@@ -146,6 +175,57 @@ class SQLite3QueueTest(unittest.TestCase):
 
         c.join()
 
+    def test_multi_threaded_size(self):
+        """Test the size is consistent with concurrent puts and gets."""
+        queue = SQLiteQueue(path=self.path, multithreading=True,
+                            auto_commit=self.auto_commit)
+
+        def producer():
+            for i in range(100):
+                queue.put(i)
+
+        def consumer():
+            for _ in range(50):
+                queue.get()
+
+        threads = [Thread(target=producer) for _ in range(4)]
+        threads += [Thread(target=consumer) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(200, queue.qsize())
+        if self.auto_commit:
+            self.assertEqual(200, queue._count())
+
+    def test_multi_threaded_put_ids(self):
+        """Test concurrent puts return the ids of their own items."""
+        queue = SQLiteQueue(path=self.path, multithreading=True,
+                            auto_commit=self.auto_commit)
+        ids = {}
+
+        def producer(seq):
+            for i in range(50):
+                item = 'var%d' % (i + (seq * 50))
+                ids[item] = queue.put(item)
+
+        producers = [Thread(target=producer, args=(seq,)) for seq in range(8)]
+        for t in producers:
+            t.start()
+        for t in producers:
+            t.join()
+        self.assertEqual(400, queue.qsize())
+        self.assertEqual(400, len(set(ids.values())))
+        for item in queue.queue():
+            self.assertEqual(ids[item['data']], item['id'])
+
+    def test_put_error(self):
+        """Test a failed put doesn't fail the following puts."""
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        self.assertRaises(sqlite3.Error, q.put, object(), raw=True)
+        q.put('var')
+        self.assertEqual('var', q.get())
+
     def test_multiple_consumers(self):
         """Test sqlqueue can be used by multiple consumers."""
 
@@ -212,6 +292,43 @@ class SQLite3QueueTest(unittest.TestCase):
         self.assertEqual(3, q.get())
         self.assertEqual(7, q.qsize())
 
+    def test_put_after_task_done_emptied(self):
+        """Test items are got after the queue is emptied by task_done."""
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        for i in range(3):
+            q.put(i)
+        for i in range(3):
+            self.assertEqual(i, q.get())
+        q.task_done()
+        # rowids are reused once the table is empty
+        q.put('var')
+        self.assertEqual('var', q.get(block=False))
+
+    def test_prefetch(self):
+        """Test read ahead records without auto_commit."""
+        q = SQLiteQueue(path=self.path, auto_commit=False)
+        ids = q.put_many(range(100))
+        self.assertEqual(0, q.get())
+        q.update('updated', id=ids[1])
+        self.assertEqual('updated', q.get())
+        self.assertEqual(ids[50], q.get(id=ids[50], raw=True)['pqid'])
+        self.assertEqual(51, q.get())
+        q.put('var')
+        self.assertEqual(list(range(52, 100)) + ['var'], q.get_many(100))
+        q.task_done()
+        q.put('var2')
+        self.assertEqual('var2', q.get(block=False))
+
+    def test_strict_ordering(self):
+        q = SQLiteQueue(path=self.path, name='strict', strict_ordering=True)
+        self.assertEqual(1, q.put('var1'))
+        q.get()
+        self.assertEqual(2, q.put('var2'))
+        q = SQLiteQueue(path=self.path, name='reused')
+        self.assertEqual(1, q.put('var1'))
+        q.get()
+        self.assertEqual(1, q.put('var2'))
+
     def test_protocol_1(self):
         shutil.rmtree(self.path, ignore_errors=True)
         q = SQLiteQueue(path=self.path)
@@ -237,6 +354,26 @@ class SQLite3QueueTest(unittest.TestCase):
         q.put(x)
         self.assertEqual(q.get(), x)
 
+    @unittest.skipIf(serializers_msgspec is None, 'msgspec is not installed')
+    def test_msgspec_serializer(self):
+        q = SQLiteQueue(
+            path=self.path,
+            serializer=serializers_msgspec)
+        x = dict(
+            a=1,
+            b=b'2',
+            c=dict(
+                d=list(range(5)),
+                e=[1]
+            ))
+        q.put(x)
+        self.assertEqual(q.get(), x)
+
+    def test_put_raw(self):
+        q = SQLiteQueue(path=self.path, serializer=serializers_json)
+        q.put(b'{"a": 1}', raw=True)
+        self.assertEqual(q.get(), {'a': 1})
+
     def test_put_0(self):
         q = SQLiteQueue(path=self.path)
         q.put(0)
@@ -262,6 +399,27 @@ class SQLite3QueueTest(unittest.TestCase):
         self.assertEqual(True, "pqid" in item)
         self.assertEqual(item.get("data"), 'val1')
 
+    def test_timestamp(self):
+        q = SQLiteQueue(path=self.path)
+        now = time.time()
+        q.put('val1')
+        stored = q._getter.execute(
+            'SELECT timestamp FROM {}'.format(q._table_name)).fetchone()[0]
+        # microseconds as integer
+        self.assertIsInstance(stored, int)
+        item = q.get(raw=True)
+        self.assertAlmostEqual(now, item['timestamp'], delta=5)
+
+    def test_put_timestamp(self):
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        q.put('val1', timestamp=1234567890.5)
+        q.put('val2')
+        item = q.get(raw=True)
+        self.assertEqual('val1', item['data'])
+        self.assertEqual(1234567890.5, item['timestamp'])
+        self.assertAlmostEqual(time.time(), q.get(raw=True)['timestamp'],
+                               delta=5)
+
     def test_queue(self):
         q = SQLiteQueue(path=self.path)
         q.put("val1")
@@ -272,6 +430,79 @@ class SQLite3QueueTest(unittest.TestCase):
         self.assertEqual(len(d), 3)
         self.assertEqual(d[1].get("data"), "val2")
 
+    def test_put_many(self):
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        q.put('first')
+        ids = q.put_many(['var%d' % i for i in range(100)])
+        self.assertEqual(100, len(ids))
+        self.assertEqual(list(range(ids[0], ids[0] + 100)), ids)
+        self.assertEqual(101, q.qsize())
+        self.assertEqual([], q.put_many([]))
+        self.assertEqual('first', q.get())
+        item = q.get(raw=True)
+        self.assertEqual(ids[0], item['pqid'])
+        self.assertEqual('var0', item['data'])
+        for i in range(1, 100):
+            self.assertEqual('var%d' % i, q.get())
+        self.assertEqual(0, q.qsize())
+
+    def test_put_many_rollback(self):
+        """Test a failed put_many doesn't put any item."""
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        self.assertRaises(sqlite3.Error, q._put_many, [b'var', object()])
+        self.assertEqual(0, q._count())
+        q.put('var')
+        self.assertEqual('var', q.get())
+
+    def test_put_async(self):
+        q = SQLiteQueue(path=self.path, multithreading=True,
+                        auto_commit=self.auto_commit)
+        futures = [q.put_async('var%d' % i) for i in range(100)]
+        ids = [f.result(timeout=10) for f in futures]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(100, q.qsize())
+        for i in range(100):
+            self.assertEqual('var%d' % i, q.get())
+
+    def test_put_async_flush(self):
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        futures = [q.put_async('var%d' % i) for i in range(100)]
+        q.flush()
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertEqual(100, q._count())
+        self.assertIn(q, sqlqueue._unflushed)
+        sqlqueue._flush_at_exit()
+        self.assertEqual(['var%d' % i for i in range(100)], q.get_many(100))
+
+    def test_get_many(self):
+        q = SQLiteQueue(path=self.path, auto_commit=self.auto_commit)
+        ids = q.put_many(['var%d' % i for i in range(10)])
+        self.assertEqual([], q.get_many(0))
+        self.assertEqual(['var0', 'var1', 'var2'], q.get_many(3))
+        items = q.get_many(2, raw=True)
+        self.assertEqual(ids[3:5], [item['pqid'] for item in items])
+        self.assertEqual(['var3', 'var4'], [item['data'] for item in items])
+        self.assertEqual(5, q.qsize())
+        self.assertEqual(['var%d' % i for i in range(5, 10)],
+                         q.get_many(10))
+        self.assertEqual([], q.get_many(10))
+        self.assertEqual(0, q.qsize())
+
+    def test_pragmas(self):
+        q = SQLiteQueue(path=self.path,
+                        pragmas={'synchronous': 'FULL', 'cache_size': None})
+        # FULL is 2
+        self.assertEqual(
+            2, q._putter.execute('PRAGMA synchronous').fetchone()[0])
+        # the default of sqlite is kept
+        self.assertEqual(
+            -2000, q._putter.execute('PRAGMA cache_size').fetchone()[0])
+        q = SQLiteQueue(path=self.path)
+        self.assertEqual(
+            1, q._putter.execute('PRAGMA synchronous').fetchone()[0])
+        self.assertEqual(
+            -64000, q._putter.execute('PRAGMA cache_size').fetchone()[0])
+
     def test_update(self):
         q = SQLiteQueue(path=self.path)
         qid = q.put("val1")
@@ -280,6 +511,31 @@ class SQLite3QueueTest(unittest.TestCase):
         self.assertEqual(item, "val2")
 
 
+class SQLite3QueueLegacySchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix='sqlqueue_legacy')
+        conn = sqlite3.connect(os.path.join(self.path, 'data.db'))
+        conn.execute(
+            'CREATE TABLE `queue_default` ('
+            '_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'data BLOB, timestamp FLOAT)')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_float_timestamp(self):
+        q = SQLiteQueue(path=self.path)
+        now = time.time()
+        q.put('val1')
+        item = q.get(raw=True)
+        self.assertEqual('val1', item['data'])
+        self.assertAlmostEqual(now, item['timestamp'], delta=5)
+        q.put('val2', timestamp=1234567890.5)
+        self.assertEqual(1234567890.5, q.get(raw=True)['timestamp'])
+
+
 class SQLite3QueueNoAutoCommitTest(SQLite3QueueTest):
     def setUp(self):
         self.path = tempfile.mkdtemp(suffix='sqlqueue_auto_commit')
@@ -323,6 +579,12 @@ class SQLite3QueueInMemory(SQLite3QueueTest):
     def test_multi_threaded_parallel(self):
         self.skipTest(self.skipstr)
 
+    def test_multi_threaded_size(self):
+        self.skipTest(self.skipstr)
+
+    def test_multi_threaded_put_ids(self):
+        self.skipTest(self.skipstr)
+
     def test_task_done_with_restart(self):
         self.skipTest('Skipped due to not persistent.')
 
@@ -356,6 +618,22 @@ class FILOSQLite3QueueTest(unittest.TestCase):
         data = q.get()
         self.assertEqual('foobar', data)
 
+    def test_get_raw(self):
+        q = FILOSQLiteQueue(self.path)
+        q.put('val1')
+        q.put('val2')
+        item = q.get(raw=True)
+        self.assertEqual(2, item['pqid'])
+        self.assertEqual('val2', item['data'])
+        self.assertIsNotNone(item['timestamp'])
+        self.assertEqual('val1', q.get())
+
+    def test_get_many(self):
+        q = FILOSQLiteQueue(self.path)
+        q.put_many(['var%d' % i for i in range(5)])
+        self.assertEqual(['var4', 'var3', 'var2'], q.get_many(3))
+        self.assertEqual(['var1', 'var0'], q.get_many(3))
+
 
 class FILOSQLite3QueueNoAutoCommitTest(FILOSQLite3QueueTest):
     def setUp(self):
@@ -383,6 +661,112 @@ class SQLite3UniqueQueueTest(unittest.TestCase):
         q = UniqueQ(self.path)
         self.assertEqual(2, q.size)
 
+    def test_put_duplicate_item_id(self):
+        q = UniqueQ(self.path)
+        _id = q.put(1111)
+        self.assertIsNotNone(_id)
+        self.assertIsNone(q.put(1111))
+        self.assertEqual(_id + 1, q.put(2222))
+
+    def test_hash_collision(self):
+        q = UniqueQ(self.path)
+        data_hash = sqlqueue._data_hash
+        sqlqueue._data_hash = lambda obj: 1
+        try:
+            q.put(1111)
+            q.put(2222)
+            q.put(1111)
+        finally:
+            sqlqueue._data_hash = data_hash
+        self.assertEqual(2, q.size)
+        self.assertEqual([1111, 2222], [i['data'] for i in q.queue()])
+
+    def test_update(self):
+        q = UniqueQ(self.path)
+        id_a = q.put('a')
+        id_x = q.put('x')
+        q.update('b', id=id_a)
+        self.assertIsNone(q.put('b'))
+        self.assertIsNotNone(q.put('a'))
+        self.assertRaises(sqlite3.IntegrityError, q.update, 'b', id=id_x)
+        # updating an item with its own data is not a duplicate
+        q.update('b', id=id_a)
+        self.assertEqual(['b', 'x', 'a'], [i['data'] for i in q.queue()])
+
+    def test_update_hash_collision(self):
+        q = UniqueQ(self.path)
+        data_hash = sqlqueue._data_hash
+        sqlqueue._data_hash = lambda obj: 1
+        try:
+            q.put(1111)
+            _id = q.put(2222)
+            q.update(3333, id=_id)
+        finally:
+            sqlqueue._data_hash = data_hash
+        self.assertEqual([1111, 3333], [i['data'] for i in q.queue()])
+
+    def test_put_raw_text(self):
+        q = UniqueQ(self.path, serializer=serializers_json)
+        self.assertIsNotNone(q.put(u'"var"', raw=True))
+        self.assertIsNone(q.put(u'"var"', raw=True))
+        self.assertEqual(1, q.size)
+
+    def test_legacy_unique_data_table(self):
+        conn = sqlite3.connect(os.path.join(self.path, 'data.db'))
+        conn.execute(
+            'CREATE TABLE `unique_queue_default` ('
+            '_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'data BLOB, timestamp FLOAT, UNIQUE (data))')
+        conn.commit()
+        conn.close()
+        q = UniqueQ(self.path)
+        self.assertIsNotNone(q.put(1111))
+        self.assertIsNone(q.put(1111))
+        self.assertEqual(1, q.size)
+        self.assertEqual(1111, q.get())
+
+    def test_put_timestamp(self):
+        q = UniqueQ(self.path)
+        self.assertIsNotNone(q.put(1111, timestamp=1234567890.5))
+        self.assertIsNone(q.put(1111, timestamp=1234567891.5))
+        self.assertEqual(1234567890.5, q.get(raw=True)['timestamp'])
+
+    def test_legacy_unique_data_protocol_4(self):
+        """Test duplicates of the items put by the older versions."""
+        conn = sqlite3.connect(os.path.join(self.path, 'data.db'))
+        conn.execute(
+            'CREATE TABLE `unique_queue_default` ('
+            '_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'data BLOB, timestamp FLOAT, UNIQUE (data))')
+        conn.execute(
+            'INSERT INTO `unique_queue_default` (data, timestamp) '
+            'VALUES (?, ?)', (pickle.dumps('x', protocol=4), time.time()))
+        conn.commit()
+        conn.close()
+        q = UniqueQ(self.path)
+        self.assertIsNone(q.put('x'))
+        self.assertEqual(['x'], [item['data'] for item in q.queue()])
+
+    def test_put_many_duplicate_items(self):
+        q = UniqueQ(self.path)
+        q.put(1111)
+        ids = q.put_many([1111, 2222, 3333, 2222])
+        self.assertIsNone(ids[0])
+        self.assertIsNotNone(ids[1])
+        self.assertIsNotNone(ids[2])
+        self.assertIsNone(ids[3])
+        self.assertEqual(3, q.size)
+        self.assertEqual(1111, q.get())
+        self.assertEqual(2222, q.get())
+        self.assertEqual(3333, q.get())
+
+    def test_put_async_duplicate_items(self):
+        q = UniqueQ(self.path, multithreading=True)
+        futures = [q.put_async(i) for i in [1, 2, 1, 3]]
+        ids = [f.result(timeout=10) for f in futures]
+        self.assertIsNone(ids[2])
+        self.assertEqual(3, q.size)
+
     def test_multiple_consumers(self):
         """Test UniqueQ can be used by multiple consumers."""
 
@@ -447,6 +831,19 @@ class SQLite3UniqueQueueTest(unittest.TestCase):
         queue.put({"bar": 2, "foo": 1})
         self.assertEqual(queue.total, 1)
 
+    @unittest.skipIf(serializers_msgspec is None, 'msgspec is not installed')
+    def test_unique_dictionary_serialization_msgspec(self):
+        queue = UniqueQ(
+            path=self.path,
+            multithreading=True,
+            auto_commit=self.auto_commit,
+            serializer=serializers_msgspec
+        )
+        queue.put({"foo": 1, "bar": 2})
+        self.assertEqual(queue.total, 1)
+        queue.put({"bar": 2, "foo": 1})
+        self.assertEqual(queue.total, 1)
+
     def test_unique_dictionary_serialization_json(self):
         queue = UniqueQ(
             path=self.path,